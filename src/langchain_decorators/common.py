@@ -1,39 +1,63 @@
 
 import re
+import bisect
+import copy
 import inspect
 import json
 import logging
 import os
+import string
+import threading
+import functools
+import hashlib
 from textwrap import dedent
 import yaml
 from enum import Enum
-from typing import Any, Coroutine, Dict, List, Union, Optional, Tuple, get_origin
-from pydantic import BaseConfig, BaseModel, Extra, Field
+from typing import Any, ClassVar, Coroutine, Dict, List, Union, Optional, Tuple, get_origin
+from pydantic import BaseConfig, BaseModel, Extra, Field, PrivateAttr
 from pydantic.fields import ModelField
 from langchain.llms.base import BaseLanguageModel
 from langchain.chat_models import ChatOpenAI
 from langchain.schema import BaseMessage
 from typing_inspect import is_generic_type, is_union_type
 
+# default for GlobalSettings.define_settings(verbose=None), evaluated once at import
+_ENV_VERBOSE = os.environ.get("LANGCHAIN_DECORATORS_VERBOSE", "").lower() in ("1", "true", "yes")
 
 
 
 class LlmSelector(BaseModel):
+    """ Create a LlmSelector that will select the llm based on the length of the prompt.
+    
+    Args:
+        generation_min_tokens (int, optional): The minimum number of tokens that the llm is expecting generate. Defaults to None (prompt_to_generation_ratio will be used).
+        prompt_to_generation_ratio (float, optional): The ratio of the prompt length to the generation length. Defaults to 1/3. 
+    """
 
     rules:List[dict]=[]
     llms:Dict[int,BaseLanguageModel]=Field(default_factory=dict)
-    streamable_llms_cache:Dict[int,BaseLanguageModel]=Field(default_factory=dict)
-    generation_min_tokens:Optional[int]
-    prompt_to_generation_ratio:Optional[float]
-
-    def __init__(self, generation_min_tokens:int=None, prompt_to_generation_ratio:float=1/3):
-        """ Create a LlmSelector that will select the llm based on the length of the prompt.
-        
-        Args:
-            generation_min_tokens (int, optional): The minimum number of tokens that the llm is expecting generate. Defaults to None (prompt_to_generation_ratio will be used).
-            prompt_to_generation_ratio (float, optional): The ratio of the prompt length to the generation length. Defaults to 1/3. 
-        """
-        super().__init__(generation_min_tokens=generation_min_tokens, prompt_to_generation_ratio=prompt_to_generation_ratio)
+    generation_min_tokens:Optional[int]=None
+    prompt_to_generation_ratio:Optional[float]=1/3
+    _rule_thresholds:List[int]=PrivateAttr(default_factory=list) # max_tokens of self.rules, kept sorted in the same order for bisect lookups
+    _exact_token_cache:Dict[bytes,int]=PrivateAttr(default_factory=dict) # digest of the prompt -> exact token count (see get_token_count)
+
+    def __init__(self, **data):
+        super().__init__(**data)
+        # rules (and llms) can be passed in directly as well
+        self.sync_rule_thresholds()
+
+    def sync_rule_thresholds(self):
+        """ Rebuilds the sorted rule thresholds from self.rules (sorting the rules and their llms by max_tokens if needed)"""
+        order = sorted(range(len(self.rules)), key=lambda rule_index: self.rules[rule_index]["max_tokens"])
+        if order != list(range(len(self.rules))):
+            rules = [self.rules[rule_index] for rule_index in order]
+            llms = {new_index:self.llms[rule_index] for new_index, rule_index in enumerate(order) if rule_index in self.llms}
+            # in place, so copies sharing these objects stay consistent
+            self.rules[:] = rules
+            self.llms.clear()
+            self.llms.update(llms)
+        self._rule_thresholds[:] = [rule["max_tokens"] for rule in self.rules]
+        self._exact_token_cache.clear()
 
 
     def with_llm(self, llm:BaseLanguageModel):
@@ -47,20 +71,23 @@ class LlmSelector(BaseModel):
         return self
 
     def with_llm_rule(self, llm:BaseLanguageModel, max_tokens:int):
-        i=-1
-        for i,rule in enumerate(self.rules):
-            rule_max_token=rule.get("max_tokens")
-            if rule_max_token and rule_max_token > max_tokens:
-                i=i-1
-                break
-        i=i+1
+        if len(self._rule_thresholds)!=len(self.rules):
+            self.sync_rule_thresholds()
+        # insert after all the rules with the same or lower max_tokens
+        i=bisect.bisect_right(self._rule_thresholds, max_tokens)
         self.rules.insert(i, dict(max_tokens=max_tokens))
+        self._rule_thresholds.insert(i, max_tokens)
+        # shift the llms of the rules that were moved by the insert (in place, copies of the selector share the dict with rules)
+        for rule_index in sorted((rule_index for rule_index in self.llms if rule_index>=i), reverse=True):
+            self.llms[rule_index+1]=self.llms.pop(rule_index)
         self.llms[i]=llm    
+        # the tokens are counted by the first llm, which might have just changed
+        self._exact_token_cache.clear()
         return self
         
     def get_model_window(self, model_name:str)->int:
-        for model_pattern, max_tokens in MODEL_LIMITS.items():
-            if re.match(model_pattern, model_name):
+        for model_pattern, max_tokens in MODEL_LIMITS:
+            if model_pattern.match(model_name):
                 return max_tokens
         
 
@@ -75,32 +102,33 @@ class LlmSelector(BaseModel):
         """
         if not self.llms:
             raise Exception("No LLMs rules added to the LlmSelector")
+        if len(self._rule_thresholds)!=len(self.rules):
+            # rules were modified directly
+            self.sync_rule_thresholds()
         
-        
-        first_rule = self.rules[0]
-        first_token_threshold = first_rule.get("max_tokens")
-        total_tokens_estimate = self.get_expected_total_tokens(prompt, function_schemas=function_schemas, estimate=True, expected_generated_tokens=expected_generated_tokens)
-        if total_tokens_estimate<first_token_threshold:
-            result_index = 0
+        # serialized once here, for both the estimate and the exact count
+        serialized_function_schemas = json.dumps(function_schemas) if function_schemas else None
+        # overestimating is safe (we'd just pick a bigger model), underestimating is not
+        total_tokens_estimate = self.get_expected_total_tokens(prompt, function_schemas=serialized_function_schemas, estimate=True, expected_generated_tokens=expected_generated_tokens) * ESTIMATE_SAFETY_MARGIN
+        estimate_index = bisect.bisect_left(self._rule_thresholds, total_tokens_estimate)
+        if len(self.rules)==1 or estimate_index>=len(self.rules):
+            # the exact count can't change the result... no need to run the tokenizer
+            result_index = len(self.rules)-1
+        elif (self._rule_thresholds[estimate_index]-total_tokens_estimate > ESTIMATE_MAX_ERROR*self._rule_thresholds[estimate_index]
+              and (estimate_index==0 or total_tokens_estimate-self._rule_thresholds[estimate_index-1] > ESTIMATE_MAX_ERROR*self._rule_thresholds[estimate_index-1])):
+            # the estimate is far enough from the thresholds above and below, the exact count would (very likely) end up in the same rule
+            result_index = estimate_index
         else:
-            total_tokens = self.get_expected_total_tokens(prompt, function_schemas=function_schemas, estimate=False, expected_generated_tokens=expected_generated_tokens) 
-            for i, rule in enumerate(self.rules):
-                max_tokens = rule.get("max_tokens")
-                if max_tokens and max_tokens >=total_tokens:
-                    result_index = i
-                    break
-
-            # if no condition is met, return the last llm
-            result_index = i
+            total_tokens = self.get_expected_total_tokens(prompt, function_schemas=serialized_function_schemas, estimate=False, expected_generated_tokens=expected_generated_tokens) 
+            # first rule with max_tokens >= total_tokens... if no condition is met, return the last llm
+            result_index = min(bisect.bisect_left(self._rule_thresholds, total_tokens), len(self.rules)-1)
         print_log(f"LLMSelector: Using {'default' if result_index==0 else str(result_index)+'-th'} LLM: {getattr(self.llms[result_index],'model_name', self.llms[result_index].__class__.__name__)}", logging.DEBUG )
         if streaming:
-            if result_index not in self.streamable_llms_cache:
-                self.streamable_llms_cache[result_index] = make_llm_streamable(self.llms[result_index])
-            return self.streamable_llms_cache[result_index]
+            return make_llm_streamable(self.llms[result_index])
         else:
             return self.llms[result_index]
     
-    def get_expected_total_tokens(self, prompt:Union[str,List[BaseMessage]], function_schemas:List[dict]=None, estimate:bool=True,expected_generated_tokens=None)->int:
+    def get_expected_total_tokens(self, prompt:Union[str,List[BaseMessage]], function_schemas:Union[List[dict],str]=None, estimate:bool=True,expected_generated_tokens=None)->int:
         expected_generated_tokens = expected_generated_tokens or self.generation_min_tokens or 0
         prompt_tokens = self.get_token_count(prompt, function_schemas=function_schemas, estimate=estimate) 
         if expected_generated_tokens:
@@ -109,21 +137,49 @@ class LlmSelector(BaseModel):
              return prompt_tokens * (1+(self.prompt_to_generation_ratio or 0))
         
     
-    def get_token_count(self, prompt:Union[str,List[BaseMessage]], function_schemas:List[dict]=None, estimate:bool=True)->int:
-        """Get the number of tokens in the prompt. If estimate is True, it will use a fast estimation, otherwise it will use the llm to count the tokens (slower)"""
+    def get_token_count(self, prompt:Union[str,List[BaseMessage]], function_schemas:Union[List[dict],str]=None, estimate:bool=True)->int:
+        """Get the number of tokens in the prompt. If estimate is True, it will use a fast estimation, otherwise it will use the llm to count the tokens (slower)
+        function_schemas can be passed already serialized (json string)
+        """
         if estimate:
-            num_tokens = int(len(prompt)/2)
+            num_tokens = count_tokens_approx(prompt)
         else:
-            num_tokens = count_tokens(prompt, llm=self.llms[0] ) # note: we will use the first llm to count the tokens... it should be the same general type, and if not, it's ok, should be close enough
+            cache_key = get_prompt_cache_key(prompt)
+            num_tokens = self._exact_token_cache.get(cache_key)
+            if num_tokens is None:
+                num_tokens = count_tokens(prompt, llm=self.llms[0] ) # note: we will use the first llm to count the tokens... it should be the same general type, and if not, it's ok, should be close enough
+                if len(self._exact_token_cache) >= EXACT_TOKEN_CACHE_SIZE:
+                    # drop the oldest entry (dicts keep the insertion order)... the selector can be shared by threads, which might be evicting at the same time
+                    try:
+                        self._exact_token_cache.pop(next(iter(self._exact_token_cache), None), None)
+                    except RuntimeError:
+                        pass # the cache was changed by another thread while iterating, we'll evict next time
+                self._exact_token_cache[cache_key] = num_tokens
         
         if function_schemas:
-            num_tokens += self.get_token_count(json.dumps(function_schemas), estimate=estimate)
+            num_tokens += self.get_function_schemas_token_count(function_schemas, estimate=estimate)
         return num_tokens
+
+    def get_function_schemas_token_count(self, function_schemas:Union[List[dict],str], estimate:bool=True)->int:
+        """Get the number of tokens of the serialized function schemas (can be passed already serialized as json string)."""
+        if not function_schemas:
+            return 0
+        serialized = function_schemas if isinstance(function_schemas, str) else json.dumps(function_schemas)
+        if estimate:
+            return estimate_tokens(serialized)
+        else:
+            return count_tokens(serialized, llm=self.llms[0])
     
 
 
 
 
+@functools.lru_cache(maxsize=None)
+def _default_chat_openai(model:str)->ChatOpenAI:
+    """ The default OpenAI llm, created only once per model (on first use) """
+    return ChatOpenAI(temperature=0.0, model=model)
+
+
 class GlobalSettings(BaseModel):
     default_llm: Optional[BaseLanguageModel] = None
     default_streaming_llm: Optional[BaseLanguageModel] = None
@@ -131,6 +187,10 @@ class GlobalSettings(BaseModel):
     verbose: bool = False
     llm_selector: Optional[LlmSelector] = None
 
+    settings_type: ClassVar[str] = "default"
+    registry: ClassVar[Dict[str, "GlobalSettings"]] = {}
+    _current: ClassVar[Optional["GlobalSettings"]] = None # cached registry[settings_type], reset by define_settings and switch_settings
+
     class Config:
         allow_population_by_field_name = True
         extra = Extra.allow
@@ -157,81 +217,123 @@ class GlobalSettings(BaseModel):
         """
         if llm_selector is None and default_llm is None and default_streaming_llm is None:
             # only use llm_selector if no default_llm and default_streaming_llm is defined, because than we dont know what rules to set up
-            default_llm = ChatOpenAI(temperature=0.0, model="gpt-3.5-turbo-0613") #  '-0613' - has function calling
+            default_llm = _default_chat_openai("gpt-3.5-turbo-0613") #  '-0613' - has function calling
             llm_selector = LlmSelector()\
                 .with_llm(default_llm)\
-                .with_llm(ChatOpenAI(temperature=0.0, model="gpt-3.5-turbo-16k-0613"))  #  '-0613' - has function calling
+                .with_llm(_default_chat_openai("gpt-3.5-turbo-16k-0613"))  #  '-0613' - has function calling
         else:
             if default_llm is None:
-                default_llm = ChatOpenAI(temperature=0.0, model="gpt-3.5-turbo-0613")  #  '-0613' - has function calling
+                default_llm = _default_chat_openai("gpt-3.5-turbo-0613")  #  '-0613' - has function calling
             if default_streaming_llm is None:
                 default_streaming_llm = make_llm_streamable(default_llm)
             
         if verbose is None:
-            verbose = os.environ.get("LANGCHAIN_DECORATORS_VERBOSE", False) in [True,"true","True","1"]
+            verbose = _ENV_VERBOSE
         settings = cls(default_llm=default_llm, default_streaming_llm=default_streaming_llm,
                        logging_level=logging_level, verbose=verbose, llm_selector=llm_selector, **kwargs)
-        if not hasattr(GlobalSettings, "registry"):
-            setattr(GlobalSettings, "registry", {})
         GlobalSettings.registry[settings_type] = settings
+        GlobalSettings._current = None
 
     @classmethod
     def get_current_settings(cls) -> "GlobalSettings":
-        if not hasattr(GlobalSettings, "settings_type"):
-            setattr(GlobalSettings, "settings_type", "default")
-        if not hasattr(GlobalSettings, "registry"):
-            GlobalSettings.define_settings()
-        return GlobalSettings.registry[GlobalSettings.settings_type]
+        current = GlobalSettings._current
+        if current is None:
+            if GlobalSettings.settings_type == "default" and "default" not in GlobalSettings.registry:
+                GlobalSettings.define_settings()
+            current = GlobalSettings._current = GlobalSettings.registry[GlobalSettings.settings_type]
+        return current
 
     @classmethod
     def switch_settings(cls, project_name):
         GlobalSettings.settings_type = project_name
+        GlobalSettings._current = None
 
 
 
 
+# raw ANSI codes used by print_log (plain strings are cheaper to access than the enum values)
+_RED = '\033[31m'
+_GREEN = '\033[32m'
+_YELLOW = '\033[33m'
+_DARK_GRAY = '\033[90m'
+_RESET = '\033[0m'
+
+
 class LogColors(Enum):
     WHITE_BOLD = "\033[1m"
-    RED = '\033[31m'
-    GREEN = '\033[32m'
-    YELLOW = '\033[33m'
+    RED = _RED
+    GREEN = _GREEN
+    YELLOW = _YELLOW
     BLUE = '\033[34m'
     MAGENTA = '\033[35m'
     CYAN = '\033[36m'
-    DARK_GRAY = '\033[90m'
+    DARK_GRAY = _DARK_GRAY
     WHITE = '\033[39m'
     BLACK_AND_WHITE = '\033[40m'
 
     # Define some reset codes to restore the default text color
-    RESET = '\033[0m'
+    RESET = _RESET
+
+
+def _get_level_color(log_level: int) -> str:
+    if log_level >= logging.ERROR:
+        return _RED
+    elif log_level >= logging.WARNING:
+        return _YELLOW
+    elif log_level >= logging.INFO:
+        return _GREEN
+    else:
+        return _DARK_GRAY
+
+# default colors of the standard log levels, other levels fall back to _get_level_color
+_LEVEL_COLORS = {log_level: _get_level_color(log_level) for log_level in (logging.DEBUG, logging.INFO, logging.WARNING, logging.ERROR, logging.CRITICAL)}
+
+# dicts and pydantic models are logged as json (much faster), set LANGCHAIN_DECORATORS_LOG_FORMAT=yaml to get the yaml output back
+_LOG_AS_YAML = os.environ.get("LANGCHAIN_DECORATORS_LOG_FORMAT", "").lower() == "yaml"
+
+
+def _format_dict_log(log_object: dict) -> str:
+    return yaml.safe_dump(log_object) if _LOG_AS_YAML else json.dumps(log_object, indent=2, default=str, ensure_ascii=False)
+
+def _format_model_log(log_object: BaseModel) -> str:
+    return yaml.safe_dump(log_object.dict()) if _LOG_AS_YAML else log_object.json(indent=2, ensure_ascii=False)
+
+# type(log_object) -> formatter (None = printed as is)
+_LOG_FORMATTERS = {str: None, dict: _format_dict_log}
+
+def _resolve_log_formatter(log_type: type):
+    """ Finds the formatter for the types missing in _LOG_FORMATTERS (subclasses, pydantic models...) and remembers it """
+    if issubclass(log_type, dict):
+        formatter = _format_dict_log
+    elif issubclass(log_type, BaseModel):
+        formatter = _format_model_log
+    else:
+        formatter = None
+    _LOG_FORMATTERS[log_type] = formatter
+    return formatter
 
 
 def print_log(log_object: Any, log_level: int, color: LogColors = None):
     settings = GlobalSettings.get_current_settings()
-    if settings.logging_level <= log_level or settings.verbose:
-        if isinstance(log_object, str):
-            pass
-        elif isinstance(log_object, dict):
-            log_object = yaml.safe_dump(log_object)
-        elif isinstance(log_object, BaseModel):
-            log_object = yaml.safe_dump(log_object.dict())
-
-        if color is None:
-            if log_level >= logging.ERROR:
-                color = LogColors.RED
-            elif log_level >= logging.WARNING:
-                color = LogColors.YELLOW
-            elif log_level >= logging.INFO:
-                color = LogColors.GREEN
-            else:
-                color = LogColors.DARK_GRAY
-        if type(color) is LogColors:
-            color = color.value
-        reset = LogColors.RESET.value if color else ""
-        print(f"{color}{log_object}{reset}\n", flush=True)
+    if not (settings.logging_level <= log_level or settings.verbose):
+        return
+
+    log_type = type(log_object)
+    formatter = _LOG_FORMATTERS[log_type] if log_type in _LOG_FORMATTERS else _resolve_log_formatter(log_type)
+    if formatter:
+        log_object = formatter(log_object)
+
+    if color is None:
+        color = _LEVEL_COLORS.get(log_level) or _get_level_color(log_level)
+    elif isinstance(color, LogColors):
+        color = color.value
+    reset = _RESET if color else ""
+    print(f"{color}{log_object}{reset}\n", flush=True)
 
 
 class PromptTypeSettings:
+    __slots__ = ("color", "log_level", "capture_stream", "llm", "llm_selector")
+
     def __init__(self, llm: BaseLanguageModel = None,  color: LogColors = None, log_level: Union[int, str] = "info", capture_stream: bool = False, llm_selector: "LlmSelector" = None):
         self.color = color
         if isinstance(log_level, str):
@@ -243,15 +345,33 @@ class PromptTypeSettings:
     
 
     def as_verbose(self):
-        return PromptTypeSettings(llm=self.llm, color=self.color, log_level=100, capture_stream=self.capture_stream)
+        verbose_settings = copy.copy(self)
+        verbose_settings.log_level = 100
+        return verbose_settings
+
+
+class _LazyClassAttribute:
+    """ Class attribute that is built by the decorated function on its first access, and reused afterwards """
+    def __init__(self, factory:callable):
+        self.factory = factory
+        self.value = None
+
+    def __get__(self, instance, owner):
+        if self.value is None:
+            self.value = self.factory()
+        return self.value
 
 
 class PromptTypes:
     UNDEFINED: PromptTypeSettings = PromptTypeSettings(
         color=LogColors.BLACK_AND_WHITE, log_level=logging.DEBUG)
-    BIG_CONTEXT: PromptTypeSettings = PromptTypeSettings(
-        llm=ChatOpenAI(temperature=0.0, model="gpt-3.5-turbo-16k"), 
-        color=LogColors.BLACK_AND_WHITE, log_level=logging.DEBUG)
+
+    @_LazyClassAttribute
+    def BIG_CONTEXT()->PromptTypeSettings:
+        # lazy, so we don't create the OpenAI client on import
+        return PromptTypeSettings(
+            llm=ChatOpenAI(temperature=0.0, model="gpt-3.5-turbo-16k"), 
+            color=LogColors.BLACK_AND_WHITE, log_level=logging.DEBUG)
         
     AGENT_REASONING: PromptTypeSettings = PromptTypeSettings(
         color=LogColors.GREEN, log_level=logging.INFO)
@@ -262,6 +382,11 @@ class PromptTypes:
 
 
 def get_func_return_type(func: callable)->Tuple:
+    # bound methods are cached by their function, so we don't keep the instances alive
+    return _get_func_return_type(getattr(func, "__func__", func))
+
+@functools.lru_cache(maxsize=1024)
+def _get_func_return_type(func: callable)->Tuple:
     return_type = func.__annotations__.get("return",None)
     if inspect.iscoroutinefunction(func):
         if return_type:
@@ -293,6 +418,11 @@ def get_func_return_type(func: callable)->Tuple:
             
             
 def get_function_docs(func: callable)->Tuple:
+    # bound methods are cached by their function, so we don't keep the instances alive
+    return _get_function_docs(getattr(func, "__func__", func))
+
+@functools.lru_cache(maxsize=1024)
+def _get_function_docs(func: callable)->Tuple:
     if not func.__doc__:
         return None
     fist_line, rest = func.__doc__.split('\n', 1) if '\n' in func.__doc__ else (func.__doc__, "")
@@ -306,21 +436,47 @@ def get_function_docs(func: callable)->Tuple:
 
             
 def get_function_full_name(func: callable)->str:
+    return _get_function_full_name(getattr(func, "__func__", func))
+
+@functools.lru_cache(maxsize=1024)
+def _get_function_full_name(func: callable)->str:
     return  f"{func.__module__}.{func.__name__}" if not func.__module__=="__main__" else func.__name__
     
 
 
+_SHARED_MODEL_CONFIG = BaseConfig()
+
 def get_arguments_as_pydantic_fields(func) -> Dict[str, ModelField]:
+    """Returns the function arguments as pydantic fields. 
+    The signature is reflected only once per (underlying) function, the caller gets its own copies of the fields, so it can modify them.
+    """
+    # bound methods are cached by their function, so we don't keep the instances alive
+    cached_fields = _get_arguments_as_pydantic_fields(getattr(func, "__func__", func), hasattr(func, "__func__"))
+    return {arg_name: _copy_model_field(field) for arg_name, field in cached_fields.items()}
+
+
+def _copy_model_field(field:ModelField) -> ModelField:
+    field_copy = copy.copy(field)
+    field_copy.field_info = copy.copy(field.field_info)
+    field_copy.field_info.extra = dict(field.field_info.extra)
+    return field_copy
+
+
+@functools.lru_cache(maxsize=1024)
+def _get_arguments_as_pydantic_fields(func, is_bound_method:bool) -> Dict[str, ModelField]:
     argument_types = {}
-    model_config = BaseConfig()
-    for arg_name, arg_desc in inspect.signature(func).parameters.items():
+    parameters = list(inspect.signature(func).parameters.items())
+    if is_bound_method:
+        # the first argument is bound to the instance
+        parameters = parameters[1:]
+    for arg_name, arg_desc in parameters:
         if arg_name != "self":
             default = arg_desc.default if arg_desc.default!=inspect.Parameter.empty else None
             if arg_desc.annotation==inspect._empty:
                 raise Exception(f"Argument '{arg_name}' of function {func.__name__} has no type annotation")
             argument_types[arg_name] = ModelField(
                 class_validators=None,
-                model_config=model_config,
+                model_config=_SHARED_MODEL_CONFIG,
                 name=arg_name, 
                 type_=arg_desc.annotation,
                 default=default,
@@ -330,8 +486,68 @@ def get_arguments_as_pydantic_fields(func) -> Dict[str, ModelField]:
     return argument_types
 
 
+STREAMABLE_LLMS_CACHE_SIZE=64
+# id(llm) -> (llm, streamable llm)... we keep the reference to llm, so its id can't be reused while cached 
+# (pydantic v1 models can't be weak-referenced), the size is bounded so the llms don't pile up if the settings are redefined often
+_STREAMABLE_LLMS_CACHE:Dict[int,Tuple[BaseLanguageModel,BaseLanguageModel]]={}
+_STREAMABLE_LLMS_CACHE_LOCK=threading.Lock()
+
 def make_llm_streamable(llm:BaseLanguageModel):
-    return llm.__class__(**llm.lc_kwargs)
+    """Returns a streaming copy of the llm. The copy is created only once per llm instance (while it stays in the cache) and reused afterwards."""
+    with _STREAMABLE_LLMS_CACHE_LOCK:
+        cached = _STREAMABLE_LLMS_CACHE.get(id(llm))
+        if cached is None or cached[0] is not llm:
+            llm_kwargs = dict(llm.lc_kwargs)
+            if hasattr(llm, "streaming"):
+                llm_kwargs["streaming"] = True
+            cached = (llm, llm.__class__(**llm_kwargs))
+            if len(_STREAMABLE_LLMS_CACHE) >= STREAMABLE_LLMS_CACHE_SIZE:
+                # drop the oldest entry (dicts keep the insertion order)
+                del _STREAMABLE_LLMS_CACHE[next(iter(_STREAMABLE_LLMS_CACHE))]
+            _STREAMABLE_LLMS_CACHE[id(llm)] = cached
+        return cached[1]
+
+EXACT_TOKEN_CACHE_SIZE=256
+ESTIMATE_SAFETY_MARGIN=1.05
+ESTIMATE_MAX_ERROR=0.2 # expected relative error of count_tokens_approx... if the estimate is closer than this to a rule threshold, the exact count is used
+MESSAGE_TOKENS_OVERHEAD=4 # role and separators of each chat message
+
+# deleting ascii letters and whitespace leaves only digits, punctuation and other symbols
+_DELETE_WORD_CHARS_TABLE=str.maketrans("", "", string.ascii_letters+string.whitespace)
+
+def estimate_tokens(text:str)->int:
+    """Fast estimate of the number of tokens in a text string, based on character classes:
+    ~4 chars per token for (english) words, ~2 for digits and punctuation and ~1 for non ascii characters (CJK etc.)
+    It rather overestimates, which is the safe direction when picking the context window.
+    """
+    ascii_text = text if text.isascii() else text.encode("ascii", "ignore").decode("ascii")
+    non_ascii_chars = len(text) - len(ascii_text)
+    symbol_chars = len(ascii_text.translate(_DELETE_WORD_CHARS_TABLE))
+    word_chars = len(ascii_text) - symbol_chars
+    return int(word_chars/4 + symbol_chars/2 + non_ascii_chars)
+
+def count_tokens_approx(prompt: Union[str,List[BaseMessage]]) -> int:
+    """Returns the estimated number of tokens in a text string or list of messages, without running the llm tokenizer."""
+    if isinstance(prompt,str):
+        return estimate_tokens(prompt)
+    elif isinstance(prompt,list):
+        return sum(estimate_tokens(msg.content) + MESSAGE_TOKENS_OVERHEAD for msg in prompt)
+    else:
+        raise ValueError(f"Unsupported prompt type {type(prompt)}. Expected str or List[BaseMessage]")
+
+def get_prompt_cache_key(prompt: Union[str,List[BaseMessage]]) -> bytes:
+    """Returns a digest of the prompt content (used to cache the token counts without keeping the prompts alive)"""
+    digest = hashlib.blake2b(digest_size=16)
+    if isinstance(prompt,str):
+        digest.update(b"s")
+        digest.update(prompt.encode("utf-8", "surrogatepass"))
+    else:
+        digest.update(b"m")
+        for msg in prompt:
+            # role (ChatMessage) and name (FunctionMessage) are counted by the tokenizer as well
+            msg_key = (msg.__class__.__name__, getattr(msg, "role", None), getattr(msg, "name", None), msg.content, msg.additional_kwargs)
+            digest.update(repr(msg_key).encode("utf-8", "surrogatepass"))
+    return digest.digest()
 
 def count_tokens(prompt: Union[str,List[BaseMessage]], llm:BaseLanguageModel) -> int:
     """Returns the number of tokens in a text string."""
@@ -341,18 +557,17 @@ def count_tokens(prompt: Union[str,List[BaseMessage]], llm:BaseLanguageModel) ->
         return llm.get_num_tokens_from_messages(prompt)
 
 
-MODEL_LIMITS={
-    "gpt-3.5-turbo-16k.*": 16_384,
-    "gpt-3.5-turbo.*": 4_096,
+# (model name pattern, max_tokens)... the first matching pattern wins, so the more specific patterns must go first
+MODEL_LIMITS:Tuple[Tuple[re.Pattern,int],...]=(
+    (re.compile(r"gpt-3.5-turbo-16k.*"), 16_384),
+    (re.compile(r"gpt-3.5-turbo.*"), 4_096),
 
-    "text-davinci-003.*": 4_097,
-    "text-davinci-003.*": 4_097,
-    "code-davinci-002.*": 8_001,
+    (re.compile(r"text-davinci-003.*"), 4_097),
+    (re.compile(r"code-davinci-002.*"), 8_001),
 
-    "gpt-4-32k.*": 32_768,
-    "gpt-4.*": 8_192,
+    (re.compile(r"gpt-4-32k.*"), 32_768),
+    (re.compile(r"gpt-4.*"), 8_192),
     
-    "claude-v1":9000,
-    "claude-v1":9000,
-    r"claude-v\d(\.\d+)?-100k":100_000,
-}
+    (re.compile(r"claude-v\d(\.\d+)?-100k"), 100_000),
+    (re.compile(r"claude-v1"), 9000),
+)
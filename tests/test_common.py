@@ -0,0 +1,26 @@
+from langchain.chat_models import ChatOpenAI
+
+from langchain_decorators import GlobalSettings, LlmSelector
+from langchain_decorators.common import make_llm_streamable
+
+
+def test_define_settings_with_default_llm():
+    llm = ChatOpenAI(temperature=0.0, model="gpt-3.5-turbo-0613", openai_api_key="sk-test")
+    GlobalSettings.define_settings(settings_type="test_default_llm", default_llm=llm)
+
+    settings = GlobalSettings.registry["test_default_llm"]
+    assert settings.default_llm is llm
+    assert settings.default_streaming_llm.streaming
+    assert not llm.streaming
+    # the streaming copy is created only once per llm
+    assert make_llm_streamable(llm) is settings.default_streaming_llm
+
+
+def test_llm_selector_streaming():
+    llm = ChatOpenAI(temperature=0.0, model="gpt-3.5-turbo-0613", openai_api_key="sk-test")
+    llm_selector = LlmSelector().with_llm(llm)
+
+    assert llm_selector.get_llm("hello") is llm
+    streaming_llm = llm_selector.get_llm("hello", streaming=True)
+    assert streaming_llm.streaming
+    assert streaming_llm is make_llm_streamable(llm)